@@ -25,12 +25,21 @@ __status__ = "Development"
 __version__ = "0.0.1"
 
 import sys, os
+import stat
+import tempfile
 import argparse
 import json
 from pprint import pprint
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
+try:
+    import orjson
+except ImportError:
+    orjson = None
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # sceleton for data scructure for internal state
 status_empty = {
@@ -39,6 +48,14 @@ status_empty = {
     }
 # global state, to be saved between invocations
 status = None
+# number of concurrent requests to the matrix server (and size of the connection pool)
+fetch_workers = 8
+
+def json_loads(data):
+    """Parse JSON from bytes (or str), using the faster orjson if it is available."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
 
 config = {}
 def log(msg):
@@ -111,9 +128,8 @@ def load_status(statusfile_name):
     Use the template in case of any error or inconsistancy."""
     status = None
     try:
-        statusfile = open(statusfile_name, 'r')
-        status = json.load(statusfile)
-        close(statusfile_name)
+        with open(statusfile_name, 'rb') as statusfile:
+            status = json_loads(statusfile.read())
     except Exception as e:
         pass
     if type(status) != dict:
@@ -123,6 +139,13 @@ def load_status(statusfile_name):
             status = status_empty
     if type(status['matrix_access_tokens']) != dict:
         status['matrix_access_tokens'] = status_empty['matrix_access_tokens']
+    # optional cache of room members (see fetch_room_users), not present in older files
+    if type(status.get('room_members')) != dict:
+        status['room_members'] = {}
+    for room_id, cached in list(status['room_members'].items()):
+        if (type(cached) != dict or type(cached.get('etag')) != str or
+            type(cached.get('users')) != list):
+            del status['room_members'][room_id]
     matrix_access_token_id = f'{matrix_user}@{matrix_host}'
     if (not matrix_access_token_id in status['matrix_access_tokens'] or
         type(status['matrix_access_tokens'][matrix_access_token_id]) != str):
@@ -140,6 +163,8 @@ status, matrix_access_token_id = load_status(statusfile_name)
 class Matrix:
     """Simple class to encapsulate a set-up Matrix configuration."""
     access_token = None
+    # list of joined rooms, if already obtained while checking the access token
+    joined_rooms = None
 
     def __init__(self, host, user, password, token=None):
         """Initilize the class and login.
@@ -149,16 +174,26 @@ class Matrix:
         latter two are still required, as it will fall back to them in case the token
         does not work (to obtain a new token)."""
         self.host = host
+        # One session for all requests, so that TCP/TLS connections to the server are
+        # kept alive and reused. Retry transient errors on the same connection pool.
         self.s = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=fetch_workers,
+                              max_retries=Retry(total=3, backoff_factor=0.3,
+                                                status_forcelist=[429, 502, 503, 504],
+                                                raise_on_status=False))
+        self.s.mount('https://', adapter)
         if token != None:
             # Check if the passed token works. Any API call that requires authentication
             # and should always work is fine here. We here request the list of joined
-            # rooms, but do not use that information later.
-            r = self.s.get(f'https://{self.host}/_matrix/client/v3/joined_rooms?access_token={token}')
+            # rooms, and keep it in case it is needed later.
+            self.set_token(token)
+            r = self.s.get(f'https://{self.host}/_matrix/client/v3/joined_rooms')
             if r.status_code != 200:
                 token = None
+                self.set_token(None)
                 log(f'matrix: existing token invalid, about to obtain a new one')
-            self.access_token = token
+            else:
+                self.joined_rooms = json_loads(r.content)['joined_rooms']
         # If no token was passed or the one that was did not work: request a new one
         if token == None:
             pdata = {
@@ -170,12 +205,23 @@ class Matrix:
             if r.status_code != 200:
                 print(f"Could not login to Matrix: {r.text}.")
                 sys.exit(1)
-            token = json.loads(r.text)['access_token']
-            self.access_token = token
+            token = json_loads(r.content)['access_token']
+            self.set_token(token)
             log(f"matrix: just logged in")
         else:
             log(f"matrix: already logged in")
 
+    def set_token(self, token):
+        """Remember the access token and send it with every request of the session.
+
+        The token is passed as header instead of as part of the URL, such that it does
+        not end up in logs of URLs."""
+        self.access_token = token
+        if token == None:
+            self.s.headers.pop('Authorization', None)
+        else:
+            self.s.headers.update({'Authorization': f'Bearer {token}'})
+
     def logout(self):
         """For completeness, as we usually do not call this: logout of Matrix.
 
@@ -183,11 +229,12 @@ class Matrix:
         and always obtaining a new one can run into rate limits."""
         if self.access_token == None:
             print("No token known: cannot logout.")
-            sys.exit(1)
-        r = self.s.post(f'https://{self.host}/_matrix/client/v3/logout?access_token={self.access_token}')
+            return
+        r = self.s.post(f'https://{self.host}/_matrix/client/v3/logout')
         if r.status_code != 200:
             print("Could not logout.")
             # Do not fail here, as we effectively achieved what we wanted.
+        self.set_token(None)
         log("matrix: logged out")
 
 matrix = None
@@ -225,34 +272,154 @@ def add_data(dates, values, date, value):
         dates.append(date)
         values.append(value)
 
-# get list of joined rooms and then get info for each
-s = requests.Session()
-r = s.get(f'https://{matrix_host}/_matrix/client/v3/joined_rooms?access_token={matrix.access_token}')
-if r.status_code != 200:
-    print("Could not get list of joined rooms")
-    sys.exit(1)
+# Get the joined rooms together with their names and members with one /sync request.
+# Only the state events we need are requested, and no timeline, presence or account data.
+sync_filter = {
+    'presence': {'not_types': ['*']},
+    'account_data': {'not_types': ['*']},
+    'room': {
+        'state': {'types': ['m.room.name', 'm.room.member']},
+        'timeline': {'types': ['m.room.name', 'm.room.member'], 'limit': 0},
+        'ephemeral': {'not_types': ['*']},
+        'account_data': {'not_types': ['*']},
+        'include_leave': False,
+        },
+    }
+s = matrix.s
+
+def parse_sync_room(room):
+    """Extract name and joined users from a room of a /sync response.
+
+    The state of the response is the one at the start of the timeline, so state events
+    in the timeline (should the server send any) are applied on top of it, in order.
+    Returns a tuple (name, users), where name is None if the room has none and users is
+    a list of user ids, or None if the response did not contain the members (e.g., due to
+    lazy-loading)."""
+    room_name = None
+    membership = {}
+    events = (room.get('state', {}).get('events', []) +
+              room.get('timeline', {}).get('events', []))
+    for event in events:
+        if not 'state_key' in event:
+            continue
+        if event['type'] == 'm.room.name':
+            room_name = event['content'].get('name')
+        elif event['type'] == 'm.room.member':
+            membership[event['state_key']] = event['content'].get('membership')
+    users = [user for user, state in membership.items() if state == 'join']
+    if not users:
+        users = None
+    return room_name, users
+
+def fetch_room_users(room_id):
+    """Get the joined users of a room.
+
+    If the server sent an ETag for the members of the room last time, ask only for changes
+    and use the users cached in the status if there are none.
+    Returns a tuple (room_id, users, etag), where users is a collection of the user ids
+    (the parsed dict of joined users, or the cached list), or None if it could not be
+    obtained. This runs in worker threads and thus must not modify global state."""
+    cached = status['room_members'].get(room_id)
+    headers = {}
+    if cached is not None and cached.get('etag'):
+        headers['If-None-Match'] = cached['etag']
+    # a single failing room should not end the whole run (and the session with it)
+    try:
+        r = s.get(f'https://{matrix_host}/_matrix/client/v3/rooms/{room_id}/joined_members',
+                  headers=headers)
+    except requests.RequestException as e:
+        print(f'Could not get list of users of room {room_id}: {e}')
+        return room_id, None, None
+    if r.status_code == 304:
+        return room_id, cached['users'], cached['etag']
+    if r.status_code != 200:
+        print(f'Could not get list of users of room {room_id}')
+        return room_id, None, None
+    return room_id, json_loads(r.content)['joined'], r.headers.get('ETag')
+
+def fetch_room_name(room_id):
+    """Get the name of a room.
+
+    Returns a tuple (room_id, name), where name is None if the room has none or it could
+    not be obtained. This runs in worker threads and thus must not modify global state."""
+    try:
+        r = s.get(f'https://{matrix_host}/_matrix/client/v3/rooms/{room_id}/state/m.room.name')
+    except requests.RequestException as e:
+        print(f'Could not get name of room {room_id}: {e}')
+        return room_id, None
+    # rooms are allowed have no name, so do not complain here
+    if r.status_code != 200:
+        return room_id, None
+    return room_id, json_loads(r.content).get('name')
 
-room_info = {}
 unique_users = set()
 isodate = datetime.now().replace(microsecond=0).isoformat()
-for room_id in json.loads(r.text)['joined_rooms']:
-    r = s.get(f'https://{matrix_host}/_matrix/client/v3/rooms/{room_id}/joined_members?access_token={matrix.access_token}')
-    if r.status_code != 200:
-        print('Could not get list of users of room {room_id}')
-    else:
-        users = set(json.loads(r.text)['joined'].keys())
-        room_info[room_id] = {'users': users}
-        if not room_id in status['rooms']:
-            r = s.get(f'https://{matrix_host}/_matrix/client/v3/rooms/{room_id}/state/m.room.name?access_token={matrix.access_token}')
-            # rooms are allowed have no name, but all we want to monitor do
-            if r.status_code != 200:
-                continue
-            room_name = json.loads(r.text)['name']
-            status['rooms'][room_id] = {'name': room_name, 'counts': [[], []]}
-        add_data(status['rooms'][room_id]['counts'][0],
-                 status['rooms'][room_id]['counts'][1],
-                 isodate, len(users)-1) # subtract 1 to exclude this user (supposedly a bot)
-        unique_users |= users
+results = {}
+try:
+    # do not mark the (bot) user as online with every run
+    r = s.get(f'https://{matrix_host}/_matrix/client/v3/sync',
+              params={'filter': json.dumps(sync_filter, separators=(',',':')),
+                      'set_presence': 'offline'})
+except requests.RequestException as e:
+    print(f"Could not sync with matrix, querying rooms separately: {e}")
+    r = None
+if r is not None and r.status_code == 200:
+    for room_id, room in json_loads(r.content).get('rooms', {}).get('join', {}).items():
+        results[room_id] = parse_sync_room(room)
+else:
+    # /sync is expensive for the server and might time out. Fall back to enumerating the
+    # joined rooms, and to querying names (of rooms not seen before) and members per room.
+    if r is not None:
+        print("Could not sync with matrix, querying rooms separately")
+    # the list of joined rooms might already be known from checking the access token
+    if matrix.joined_rooms is None:
+        try:
+            r = s.get(f'https://{matrix_host}/_matrix/client/v3/joined_rooms')
+        except requests.RequestException as e:
+            print(f"Could not get list of joined rooms: {e}")
+            sys.exit(1)
+        if r.status_code != 200:
+            print("Could not get list of joined rooms")
+            sys.exit(1)
+        matrix.joined_rooms = json_loads(r.content)['joined_rooms']
+    for room_id in matrix.joined_rooms:
+        results[room_id] = (None, None)
+    unknown = [room_id for room_id in results if not room_id in status['rooms']]
+    with ThreadPoolExecutor(max_workers=fetch_workers) as ex:
+        for room_id, room_name in ex.map(fetch_room_name, unknown):
+            results[room_id] = (room_name, None)
+# Only if the server did not include the members in the /sync response (or /sync failed),
+# query them per room: concurrently over the shared session (one worker per pooled
+# connection), but merge the results here, so the global state is only modified by one
+# thread.
+# HTTP/2 (e.g. using httpx) is deliberately not used for this: usually all room data
+# arrives with the single /sync request, so multiplexing would only speed up this rare
+# fallback at the cost of an additional dependency.
+missing = [room_id for room_id, (room_name, users) in results.items() if users is None]
+etags = {}
+if missing:
+    log(f'matrix: querying members of {len(missing)} rooms separately')
+    with ThreadPoolExecutor(max_workers=fetch_workers) as ex:
+        for room_id, users, etag in ex.map(fetch_room_users, missing):
+            results[room_id] = (results[room_id][0], users)
+            etags[room_id] = etag
+# only keep cache entries of rooms that were queried this time (and are monitored)
+status['room_members'] = {}
+for room_id, (room_name, users) in results.items():
+    if users is None:
+        continue
+    if not room_id in status['rooms']:
+        # rooms are allowed have no name, but all we want to monitor do
+        if room_name is None:
+            continue
+        status['rooms'][room_id] = {'name': room_name, 'counts': [[], []]}
+    if etags.get(room_id) is not None:
+        status['room_members'][room_id] = {'etag': etags[room_id], 'users': sorted(users)}
+    add_data(status['rooms'][room_id]['counts'][0],
+             status['rooms'][room_id]['counts'][1],
+             isodate, len(users)-1) # subtract 1 to exclude this user (supposedly a bot)
+    # the users themselves are only kept in the union over all rooms
+    unique_users.update(users)
 if not 'total' in status['rooms']:
     status['rooms']['total'] = {'name': 'Total', 'counts': [[], []]}
 add_data(status['rooms']['total']['counts'][0],
@@ -265,21 +432,55 @@ if config['matrix_always_logout']:
     matrix.logout()
     del status['matrix_access_tokens'][matrix_access_token_id]
 
+def write_file(filename, data, mode=None):
+    """Write the bytes 'data' to 'filename', replacing the file atomically.
+
+    The data is written to a new temporary file next to the target first, which is then
+    renamed, such that an interrupted run never leaves a truncated file behind. A symlink
+    as 'filename' is followed, such that the file it points to is replaced. The temporary
+    file is created accessible only by the user and then set to 'mode', which by default
+    is the mode of the existing file, or the one 'open()' would use for a new file."""
+    filename = os.path.realpath(filename)
+    if mode is None:
+        try:
+            mode = stat.S_IMODE(os.stat(filename).st_mode)
+        except FileNotFoundError:
+            umask = os.umask(0)
+            os.umask(umask)
+            mode = 0o666 & ~umask
+    file_desc, tmp_name = tempfile.mkstemp(dir=os.path.dirname(filename),
+                                           prefix=os.path.basename(filename) + '.')
+    try:
+        with open(file_desc, 'wb') as tmpfile:
+            os.fchmod(tmpfile.fileno(), mode)
+            tmpfile.write(data)
+            tmpfile.flush()
+            os.fsync(tmpfile.fileno())
+        os.replace(tmp_name, filename)
+    except:
+        try:
+            os.unlink(tmp_name)
+        except OSError:
+            pass
+        raise
+
+# Encode the room data, by far the largest part, only once and use it for both files.
+# The one-value-per-line format keeps changes of the counter file easy to follow.
+rooms_json = json.dumps(status['rooms'], indent=0, separators=(',',':')).encode()
+
 # save current state. Since this also contains the access token, make sure to create the
 # file with safe access permissions.
 try:
-    file_desc = os.open(path=statusfile_name,
-                        flags=os.O_WRONLY|os.O_CREAT|os.O_TRUNC, mode=0o600)
-    statusfile = open(file_desc, 'w')
-    json.dump(status, statusfile)
-    statusfile.close()
+    status_json = b'{'
+    for key, value in status.items():
+        if key != 'rooms':
+            status_json += json.dumps(key).encode() + b':' + json.dumps(value).encode() + b','
+    status_json += b'"rooms":' + rooms_json + b'}'
+    write_file(statusfile_name, status_json, mode=0o600)
 except Exception as e:
     print(e)
     pass
 
 # save counters. This is the same file format as the state, but only contains the counters
 # and especially no authorization information
-with open(counterfile_name, 'w') as counterfile:
-    json.dump({'rooms': status['rooms']}, counterfile, indent=0, separators=(',',':'))
-    counterfile.close()
-
+write_file(counterfile_name, b'{\n"rooms":' + rooms_json + b'\n}')
@@ -28,7 +28,7 @@ import sys, os
 from pprint import pprint
 import argparse
 import json
-from datetime import datetime
+import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.ticker import MaxNLocator
 import matplotlib.dates as mdates
@@ -57,8 +57,8 @@ scaling = .6
 fig = plt.figure(figsize=(16*scaling, 9*scaling))
 ax = fig.subplots()
 
-xmin=datetime.fromisoformat('2999-01-01T00:00:00')
-xmax=datetime.fromisoformat('1999-01-01T00:00:00')
+xmin=np.datetime64('2999-01-01T00:00:00')
+xmax=np.datetime64('1999-01-01T00:00:00')
 
 # go through all rooms and sort by current (last) user count
 for room, roomdata in sorted(data['rooms'].items(), key=lambda x: x[1]['counts'][1][-1]):
@@ -69,19 +69,20 @@ for room, roomdata in sorted(data['rooms'].items(), key=lambda x: x[1]['counts']
         continue
     if roomdata['name'].startswith('de-RSE-alt'):
         continue
-    # convert data to the right types for plotting
-    times  = [datetime.fromisoformat(s) for s in roomdata['counts'][0]]
-    counts = roomdata['counts'][1]
+    # convert data to the right types for plotting: numpy parses the ISO times in one go
+    times  = np.array(roomdata['counts'][0], dtype='datetime64[s]')
+    counts = np.array(roomdata['counts'][1], dtype=int)
     # add one more "fake" datapoint, as stairs() requires len(edges) = len(data)+1
-    times.append(times[-1])
+    times  = np.append(times, times[-1])
     # get global extrema as limits later
-    xmin = min(xmin, times[0])
-    xmax = max(xmax, times[-1])
-    # the actual plot line
-    ax.stairs(counts, edges=times, lw=2, label=roomdata['name'])
+    xmin = np.minimum(xmin, times.min())
+    xmax = np.maximum(xmax, times.max())
+    # the actual plot line; pass the edges as matplotlib date numbers, converted at once
+    ax.stairs(counts, edges=mdates.date2num(times), lw=2, label=roomdata['name'])
 
 # limit to the observed time range and ensure ymin to be 0
-ax.set_xlim(xmin=xmin, xmax=xmax)
+ax.xaxis_date()
+ax.set_xlim(xmin=mdates.date2num(xmin), xmax=mdates.date2num(xmax))
 ax.set_ylim(ymin=0)
 
 # some plot cosmetics